@@ -4,15 +4,30 @@ Copyright (c) 2025 Kota UCHIDA
 Data repository classes. Git or KiCad's backup directory.
 '''
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 import logging
+import os
 from pathlib import Path
-import re
 import shutil
 import subprocess
+import threading
 import zipfile
 
-BACKUP_DATE_PAT = re.compile(r'\d{4}-\d{2}-\d{2}_\d{6}')
+def _tmp_for(dst_path):
+    '''
+    os.replace で dst_path に置き換えるための一時ファイル名。
+    スレッド ID 入りなので並行リクエスト間で衝突しない。
+    '''
+    return dst_path.with_name(f'{dst_path.name}.tmp{os.getpid()}.{threading.get_ident()}')
+
+def is_backup_date(s):
+    '''
+    s が YYYY-MM-DD_HHMMSS 形式なら真（正規表現より軽い）
+    '''
+    return (len(s) == 17
+            and s[4] == '-' and s[7] == '-' and s[10] == '_'
+            and s[:4].isdigit() and s[5:7].isdigit() and s[8:10].isdigit()
+            and s[11:].isdigit())
 
 GitCommitLog = namedtuple('GitCommitLog', ['hash', 'refs', 'author_name', 'author_date', 'subject', 'body'])
 
@@ -34,6 +49,81 @@ class Git:
             else:
                 p = p.parent
 
+        # git cat-file --batch を常駐させ、extract_file のたびに
+        # git を起動し直すコストを省く
+        self._catfile = None
+        self._catfile_lock = threading.Lock()
+
+        # get_commit_logs の結果を HEAD が動くまでキャッシュする
+        self._log_cache = None
+        self._log_head = None
+
+    def _get_catfile_proc(self):
+        if self._catfile is None or self._catfile.poll() is not None:
+            self._catfile = subprocess.Popen(
+                ['git', 'cat-file', '--batch'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                cwd=self.git_root, bufsize=0)
+        return self._catfile
+
+    def _reset_catfile(self):
+        '''
+        要求と応答がずれた可能性のある cat-file プロセスを破棄する。
+        次回の呼び出しで新しいプロセスが起動される。self._catfile_lock を
+        保持した状態で呼ぶこと。
+        '''
+        logger.warning('git cat-file stream is broken. discarding the process')
+        if self._catfile is not None:
+            self._catfile.kill()
+            self._catfile = None
+
+    def _extract_file_catfile(self, commit_id, rel_path, dst_path):
+        '''
+        常駐する git cat-file --batch からファイルを抽出する。
+        成功したら真を返す。
+        '''
+        query = f'{commit_id}:{rel_path}'
+        if '\n' in query:
+            # 改行入りの要求は 2 行と解釈されてストリームがずれるので
+            # 書き込まず git show のフォールバックに任せる
+            return False
+
+        with self._catfile_lock:
+            try:
+                proc = self._get_catfile_proc()
+                proc.stdin.write((query + '\n').encode())
+                # ヘッダ例: '<sha> blob <size>\n'（存在しなければ '... missing\n'）
+                header = proc.stdout.readline().split()
+                if len(header) != 3 or header[1] != b'blob':
+                    if len(header) != 2 or header[1] != b'missing':
+                        # 'missing' 以外の想定外応答はずれているとみなす
+                        self._reset_catfile()
+                    return False
+                size = int(header[2])
+                # 書き込み途中のファイルが他のスレッドから見えないように、
+                # 一時ファイルに書いてから os.replace で置き換える
+                tmp_path = _tmp_for(dst_path)
+                with open(tmp_path, 'wb') as f:
+                    remain = size
+                    while remain > 0:
+                        chunk = proc.stdout.read(remain)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        remain -= len(chunk)
+                if remain > 0:
+                    os.unlink(tmp_path)
+                    self._reset_catfile()
+                    return False
+                if proc.stdout.read(1) != b'\n':  # blob 末尾の改行を捨てる
+                    self._reset_catfile()
+                os.replace(tmp_path, dst_path)
+                return True
+            except OSError:
+                logger.warning('git cat-file process failed. falling back to git show')
+                self._reset_catfile()
+                return False
+
     def extract_file(self, commit_id, file_name, dst_path):
         '''
         commit_id に含まれる file_name を dst_path へ抽出する。
@@ -42,67 +132,61 @@ class Git:
         file_path = self.kicad_proj_dir / file_name
 
         if commit_id is None:
-            # ワーキングツリーからファイル取得
-            shutil.copy(file_path, dst_path)
+            # ワーキングツリーからファイル取得。
+            # 同一ファイルシステムならハードリンクで全バイトコピーを省く。
+            try:
+                if os.path.samefile(file_path, dst_path):
+                    # 前回のリンクがまだ同じ inode を指しているので何もしない
+                    return
+            except OSError:
+                pass
+            # dst_path を直接触らず一時名から os.replace するので、
+            # 並行リクエストには常に完全なファイルだけが見える
+            tmp_path = _tmp_for(dst_path)
+            try:
+                os.link(file_path, tmp_path)
+            except OSError:
+                shutil.copy(file_path, tmp_path)
+            os.replace(tmp_path, dst_path)
+            # rename 元と先が同じ inode だと os.replace は何もせず
+            # 一時ファイルが残ることがある（POSIX の規定どおり）ため掃除する
+            tmp_path.unlink(missing_ok=True)
             return
 
         rel_path = file_path.relative_to(self.git_root)
+        if self._extract_file_catfile(commit_id, rel_path, dst_path):
+            return
+
+        # cat-file が使えない場合のフォールバック
         git_show_cmd = ['git', 'show', f'{commit_id}:{rel_path}']
         res = subprocess.run(git_show_cmd, capture_output=True, cwd=self.git_root)
-        with open(dst_path, 'wb') as f:
+        tmp_path = _tmp_for(dst_path)
+        with open(tmp_path, 'wb') as f:
             f.write(res.stdout)
-            pass
+        os.replace(tmp_path, dst_path)
 
     def get_commit_logs(self):
-        # コミットメッセージに現れない記号パターン（^@_@^）で区切る
-        d = '^@_@^'
-        git_log_cmd = ['git', 'log', '--date=iso',
-                       f'--pretty=format:"#%H{d}%D{d}%an{d}%ad{d}%s{d}%b{d}"']
-        res = subprocess.run(git_log_cmd, capture_output=True, cwd=self.git_root, encoding='utf-8')
+        # HEAD が変わっていなければキャッシュを返す（rev-parse は git log より遥かに安い）
+        rev_parse_cmd = ['git', 'rev-parse', 'HEAD']
+        head = subprocess.run(rev_parse_cmd, capture_output=True,
+                              cwd=self.git_root, encoding='utf-8').stdout.strip()
+        if self._log_cache is not None and head == self._log_head:
+            return self._log_cache
+
+        # -z でコミット間を NUL 区切りにし、フィールド間は \x1f で区切る
+        git_log_cmd = ['git', 'log', '-z', '--date=iso',
+                       '--pretty=format:%H%x1f%D%x1f%an%x1f%ad%x1f%s%x1f%b']
+        res = subprocess.run(git_log_cmd, capture_output=True, cwd=self.git_root)
 
         commit_logs = []
-        pos = 0
-        while True:
-            # commit hash
-            hash_pos = res.stdout.find('#', pos)
-            if hash_pos < 0:
-                break
-            hash_pos += 1
-
-            # hash example: 18b0278859c3d0a3aef8d3857d6fe827cfd63213
-            hash_end = res.stdout.find(d, hash_pos)
-            commit_hash = res.stdout[hash_pos:hash_end]
-            if hash_end - hash_pos != 40:
-                raise ValueError(f'hash ("{commit_hash}") length is expected to be 40')
-
-            refs_end = res.stdout.find(d, hash_end + len(d))
-            if refs_end < 0:
-                raise ValueError(f'refs not found: log="{res.stdoud[hash_pos:hash_end+100]}"')
-            refs = res.stdout[hash_end + len(d):refs_end]
-
-            an_end = res.stdout.find(d, refs_end + len(d))
-            if an_end < 0:
-                raise ValueError(f'author name not found: log="{res.stdoud[hash_pos:hash_end+100]}"')
-            an = res.stdout[refs_end + len(d):an_end]
-
-            ad_end = res.stdout.find(d, an_end + len(d))
-            if ad_end < 0:
-                raise ValueError(f'author date not found: log="{res.stdoud[hash_pos:hash_end+100]}"')
-            ad = res.stdout[an_end + len(d):ad_end]
-
-            s_end = res.stdout.find(d, ad_end + len(d))
-            if s_end < 0:
-                raise ValueError(f'subject not found: log="{res.stdoud[hash_pos:hash_end+100]}"')
-            s = res.stdout[ad_end + len(d):s_end]
-
-            b_end = res.stdout.find(d, s_end + len(d))
-            if b_end < 0:
-                raise ValueError(f'body not found: log="{res.stdoud[hash_pos:hash_end+100]}"')
-            b = res.stdout[s_end + len(d):b_end]
-
-            pos = b_end + len(d)
-            commit_logs.append(GitCommitLog(commit_hash, refs, an, ad, s, b))
+        for record in res.stdout.split(b'\0'):
+            fields = record.split(b'\x1f', 5)
+            if len(fields) == 6:
+                commit_logs.append(GitCommitLog(
+                    *[f.decode('utf-8', 'replace') for f in fields]))
 
+        self._log_cache = commit_logs
+        self._log_head = head
         return commit_logs
 
 class Backups:
@@ -111,26 +195,69 @@ class Backups:
         self.kicad_pro_path = next(kicad_proj_dir.glob('*.kicad_pro'))
         self.backups_dir = self.kicad_proj_dir / (self.kicad_pro_path.stem + '-backups')
 
+        # get_versions の結果をディレクトリの mtime が動くまでキャッシュする
+        self._versions_cache = None
+        self._versions_mtime = None
+
+        # 開いた ZipFile を使い回し、セントラルディレクトリの再読込を避ける
+        self._zips = OrderedDict()
+
+    ZIP_CACHE_SIZE = 8
+
+    def _get_zip(self, zip_name):
+        zf = self._zips.get(zip_name)
+        if zf is not None:
+            self._zips.move_to_end(zip_name)
+            return zf
+
+        zf = zipfile.ZipFile(self.backups_dir / zip_name)
+        self._zips[zip_name] = zf
+        if len(self._zips) > self.ZIP_CACHE_SIZE:
+            _, oldest = self._zips.popitem(last=False)
+            oldest.close()
+        return zf
+
+    def close(self):
+        for zf in self._zips.values():
+            zf.close()
+        self._zips.clear()
+
     def extract_file(self, version, file_name, dst_path):
         '''
         version が示す zip に含まれる file_path を dst_path へ抽出する。
         version が None なら、ワーキングツリーのファイルをそのまま dst_path へコピーする。
         '''
         zip_name = f'{self.kicad_pro_path.stem}-{version}.zip'
-        with zipfile.ZipFile(self.backups_dir / zip_name) as zf:
-            with zf.open(file_name) as src:
-                with open(dst_path, 'wb') as dst:
-                    shutil.copyfileobj(src, dst)
+        zf = self._get_zip(zip_name)
+        # 書き込み途中のファイルが他のスレッドから見えないように、
+        # 一時ファイルに書いてから os.replace で置き換える
+        tmp_path = _tmp_for(dst_path)
+        with zf.open(file_name) as src:
+            with open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, dst_path)
 
     def get_versions(self):
+        try:
+            mtime = os.stat(self.backups_dir).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._versions_cache is not None and mtime == self._versions_mtime:
+            return self._versions_cache
+
+        # ファイル名は '<projstem>-<date>.zip' で固定
+        prefix_len = len(self.kicad_pro_path.stem) + 1
         zips = self.backups_dir.glob('*.zip')
         versions = []
         for zf in zips:
-            m = BACKUP_DATE_PAT.search(zf.stem)
-            if not m:
+            tag = zf.stem[prefix_len:]
+            if not is_backup_date(tag):
                 continue
-            versions.append(m.group(0))
-        return sorted(versions, reverse=True)
+            versions.append(tag)
+
+        self._versions_cache = sorted(versions, reverse=True)
+        self._versions_mtime = mtime
+        return self._versions_cache
 
 class Repo:
     def __init__(self, git_repo, backups_repo):
@@ -143,11 +270,17 @@ class Repo:
         日付以外なら Git リポジトリからファイルを抽出する。
         '''
         logger.debug('extract_file: ver=%s file=%s dst=%s', version, file_name, dst_path)
-        if dst_path.exists():
-            return
+        # ワーキングツリー (version=None) は変化しうるので毎回コピーし直す
+        if version is not None:
+            try:
+                # 抽出済みなら syscall 1 回で終わらせる
+                os.stat(dst_path)
+                return
+            except FileNotFoundError:
+                pass
         dst_path.parent.mkdir(parents=True, exist_ok=True)
 
-        if version is None or BACKUP_DATE_PAT.match(version) is None:
+        if version is None or not is_backup_date(version):
             return self.git_repo.extract_file(version, file_name, dst_path)
         else:
             return self.backups_repo.extract_file(version, file_name, dst_path)
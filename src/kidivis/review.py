@@ -7,11 +7,15 @@ The web server to interact with users.
 '''
 
 import argparse
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+import functools
+import hashlib
 import http.server
 from itertools import product
 import logging
+import mmap
 import os
 from pathlib import Path
 import re
@@ -19,6 +23,7 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import urllib.parse
 import uuid
 
@@ -28,23 +33,33 @@ from . import diffimg
 from . import repo
 
 LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'critical']
-SCH_PROPERTY_PAT = re.compile(r'\(property\s+"(?P<name>[^"]+)"\s+"(?P<value>[^"]+)"')
+SCH_PROPERTY_PAT = re.compile(rb'\(property\s+"(?P<name>[^"]+)"\s+"(?P<value>[^"]+)"')
+SHEET_OPEN_PAT = re.compile(rb'\(sheet\s')
 
 KicadSheet = namedtuple('KicadSheet', ['name', 'file'])
 
 logger = logging.getLogger(__name__)
 
-def convert_path_to_windows(file_path):
-    path_cmd = ['wslpath', '-w', file_path]
+@functools.lru_cache(maxsize=1024)
+def _convert_str_to_windows(path_str):
+    path_cmd = ['wslpath', '-w', path_str]
     res = subprocess.run(path_cmd, capture_output=True)
     res.check_returncode()
     return Path(res.stdout.decode('utf-8').strip())
 
+def convert_path_to_windows(file_path):
+    # 変換対象はほぼ一時ディレクトリ配下なので結果をキャッシュしておく
+    return _convert_str_to_windows(str(file_path))
+
+@functools.lru_cache(maxsize=None)
+def _wslpath_exists():
+    return Path('/usr/bin/wslpath').exists()
+
 def using_kicadwin_from_wsl(kicad_cli):
     '''
     KiCad for Windows を WSL から使う場合に真
     '''
-    return Path('/usr/bin/wslpath').exists() and kicad_cli.endswith('.exe')
+    return _wslpath_exists() and kicad_cli.endswith('.exe')
 
 def export_svgs(dst_dir_path, mode, file_path, kicad_cli, layers, fit_board):
     dst_dir_path_for_cmd = dst_dir_path
@@ -90,6 +105,23 @@ def export_svgs(dst_dir_path, mode, file_path, kicad_cli, layers, fit_board):
             os.rename(svg, svg.parent / new_name)
             logger.debug('file renamed: %s => %s', svg, svg.parent / new_name)
 
+def hash_file_contents(paths):
+    h = hashlib.sha1()
+    for p in paths:
+        h.update(p.read_bytes())
+    return h.hexdigest()[:16]
+
+# export 済みの SVG キャッシュディレクトリを記録する
+_exported_svg_dirs = set()
+
+# 同じディレクトリへの export が並行して走らないようにするためのロック群
+_export_locks = {}
+_export_locks_guard = threading.Lock()
+
+def _get_export_lock(key):
+    with _export_locks_guard:
+        return _export_locks.setdefault(key, threading.Lock())
+
 def make_pcbsvg_filename(pcb_file_name, layer_name):
     l = layer_name.replace('.', '_')
     return f'{Path(pcb_file_name).stem}-{l}.svg'
@@ -119,9 +151,12 @@ def action_image(req, diff_base, diff_target, filename):
     req.kicad_repo.extract_file(diff_base, file_path.name, base_file_path)
     req.kicad_repo.extract_file(diff_target, file_path.name, target_file_path)
 
+    base_hash_files = [base_file_path]
+    target_hash_files = [target_file_path]
+
     if mode == 'sch':
         # 階層シートの回路図を持ってこないと階層シートの SVG が空になってしまう
-        sheets = get_sch_subsheets_recursive(req.sch_path)
+        sheets = req.sheet_cache.get(req.sch_path)
         for sheet in sheets:
             req.kicad_repo.extract_file(diff_base,
                                         sheet.file,
@@ -129,9 +164,13 @@ def action_image(req, diff_base, diff_target, filename):
             req.kicad_repo.extract_file(diff_target,
                                         sheet.file,
                                         target_dir / sheet.file)
+            base_hash_files.append(base_dir / sheet.file)
+            target_hash_files.append(target_dir / sheet.file)
 
-    base_svg_dir = base_dir / mode
-    target_svg_dir = target_dir / mode
+    # SVG キャッシュはバージョン名ではなく抽出したファイルの内容で引く。
+    # WORK のように中身が変わりうるバージョンでも古い SVG を返さない。
+    base_svg_dir = req.tmp_dir_path / 'svg' / mode / hash_file_contents(base_hash_files)
+    target_svg_dir = req.tmp_dir_path / 'svg' / mode / hash_file_contents(target_hash_files)
     if mode == 'pcb':
         fb = 'fit_board' if req.fit_board else 'nofit_board'
         base_svg_dir = base_svg_dir / fb
@@ -145,10 +184,37 @@ def action_image(req, diff_base, diff_target, filename):
     def export_svgs_(d, f):
         export_svgs(d, mode, f, req.kicad_cli, req.layers, req.fit_board)
 
-    if not base_svg_path.exists():
-        export_svgs_(base_svg_dir, base_file_path)
-    if not target_svg_path.exists():
-        export_svgs_(target_svg_dir, target_file_path)
+    # kicad-cli は 1 回の呼び出しで全レイヤ（全シート）を出力するので、
+    # レイヤ単位ではなくディレクトリ単位で出力済みかどうかを管理する
+    to_export = {}
+    for svg_dir, src_path in [(base_svg_dir, base_file_path),
+                              (target_svg_dir, target_file_path)]:
+        key = str(svg_dir)
+        if key in _exported_svg_dirs:
+            continue
+        if (svg_dir / '.done').exists():
+            _exported_svg_dirs.add(key)
+            continue
+        to_export[key] = (svg_dir, src_path)
+
+    def export_and_mark(svg_dir, src_path):
+        key = str(svg_dir)
+        with _get_export_lock(key):
+            # ロック待ちの間に他のスレッドが export し終えたかもしれない
+            if key in _exported_svg_dirs or (svg_dir / '.done').exists():
+                _exported_svg_dirs.add(key)
+                return
+            svg_dir.mkdir(parents=True, exist_ok=True)
+            export_svgs_(svg_dir, src_path)
+            (svg_dir / '.done').touch()
+            _exported_svg_dirs.add(key)
+
+    if len(to_export) == 1:
+        export_and_mark(*next(iter(to_export.values())))
+    elif to_export:
+        # base と target の kicad-cli は独立なので並走させる
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(lambda p: export_and_mark(*p), to_export.values()))
 
     with open(base_svg_path) as f:
         base_svg = f.read()
@@ -163,82 +229,117 @@ def action_image(req, diff_base, diff_target, filename):
         return
 
     svg_pos += 4
-    overlayed_svg = overlayed_svg[:svg_pos] + ' id="overlayed_svg"' + overlayed_svg[svg_pos:]
 
-    encoded_svg = overlayed_svg.encode('utf-8')
+    # 巨大な SVG を 1 つの bytes に連結し直すと
+    # ピークメモリが倍増するので、3 分割のまま書き出す
+    head = overlayed_svg[:svg_pos].encode('utf-8')
+    inject = b' id="overlayed_svg"'
+    tail = overlayed_svg[svg_pos:].encode('utf-8')
 
     req.send_response(200)
     req.send_header('Content-Type', 'image/svg+xml')
-    req.send_header('Content-Length', len(encoded_svg))
+    req.send_header('Content-Length', len(head) + len(inject) + len(tail))
     req.end_headers()
-    req.wfile.write(encoded_svg)
+    req.wfile.write(head)
+    req.wfile.write(inject)
+    req.wfile.write(tail)
 
 def get_sch_subsheets(sch_path):
-    with open(sch_path) as f:
-        sch_src = f.read()
-
-    if not sch_src.startswith('(kicad_sch'):
-        raise SyntaxError('kicad_sch has invalid syntax')
-
-    sheets = []
-    pos = 0
-    while pos < len(sch_src):
-        pos = sch_src.find('(sheet', pos)
-        if pos < 0:
-            break
-        pos += 6
-        if not sch_src[pos].isspace():
-            # '(sheet_instances' などがヒットしたため、検索しなおす
-            continue
-
-        # '(sheet' に対応する閉じ括弧を探す
-        paren = 1
-        sheet_end_pos = -1
-        for i in range(pos, len(sch_src)):
-            if sch_src[i] == '(':
-                paren += 1
-            elif sch_src[i] == ')':
-                paren -= 1
-
-            if paren == 0: # end of sheet
-                sheet_end_pos = i
-                break
-        if sheet_end_pos < 0:
-            raise SyntaxError('sheet is not closed')
-
-        sheetname = None
-        sheetfile = None
-        while pos < sheet_end_pos:
-            m = SCH_PROPERTY_PAT.search(sch_src, pos, sheet_end_pos)
+    # ファイル全体を str へ decode せず、mmap したバイト列のまま検索する。
+    # decode するのはヒットした property の name/value だけで済む。
+    with open(sch_path, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:10] != b'(kicad_sch':
+            raise SyntaxError('kicad_sch has invalid syntax')
+
+        sheets = []
+        pos = 0
+        while True:
+            # '(sheet_instances' などは \s が続かないのでヒットしない
+            m = SHEET_OPEN_PAT.search(mm, pos)
             if m is None:
                 break
             pos = m.end()
 
-            name = m.group('name')
-            value = m.group('value')
-            if name == 'Sheetname' or name == 'Sheet name':
-                sheetname = value
-            elif name == 'Sheetfile' or name == 'Sheet file':
-                sheetfile = value
-
-        pos = sheet_end_pos + 1
-
-        if sheetname is None or sheetfile is None:
-            raise SyntaxError('no "Sheetname" or "Sheetfile" in sheet object')
-
-        sheets.append(KicadSheet(sheetname, sheetfile))
-
-    return sheets
-
-def get_sch_subsheets_recursive(sch_path):
-    sheets = get_sch_subsheets(sch_path)
+            # '(sheet' に対応する閉じ括弧を探す。
+            # 1 文字ずつ見るのではなく find で括弧の間を一気に飛ばす。
+            paren = 1
+            i = pos
+            while paren > 0:
+                open_pos = mm.find(b'(', i)
+                close_pos = mm.find(b')', i)
+                if close_pos < 0:
+                    raise SyntaxError('sheet is not closed')
+                if 0 <= open_pos < close_pos:
+                    paren += 1
+                    i = open_pos + 1
+                else:
+                    paren -= 1
+                    i = close_pos + 1
+            sheet_end_pos = i - 1
+
+            sheetname = None
+            sheetfile = None
+            while pos < sheet_end_pos:
+                m = SCH_PROPERTY_PAT.search(mm, pos, sheet_end_pos)
+                if m is None:
+                    break
+                pos = m.end()
+
+                name = m.group('name')
+                value = m.group('value')
+                if name == b'Sheetname' or name == b'Sheet name':
+                    sheetname = value.decode('utf-8')
+                elif name == b'Sheetfile' or name == b'Sheet file':
+                    sheetfile = value.decode('utf-8')
+
+            pos = sheet_end_pos + 1
+
+            if sheetname is None or sheetfile is None:
+                raise SyntaxError('no "Sheetname" or "Sheetfile" in sheet object')
+
+            sheets.append(KicadSheet(sheetname, sheetfile))
+
+        return sheets
+
+@functools.lru_cache(maxsize=256)
+def _get_sch_subsheets_cached(sch_path, mtime_ns):
+    # mtime_ns はファイル更新時にキャッシュを無効化するためのキー
+    return get_sch_subsheets(sch_path)
+
+def _walk_sch_subsheets(sch_path, out, seen):
+    if sch_path in seen:
+        return
+    seen.add(sch_path)
 
     sch_dir = sch_path.parent
-    for sheet in sheets:
-        sheets.extend(get_sch_subsheets_recursive(sch_dir / sheet.file))
+    for sheet in _get_sch_subsheets_cached(sch_path, sch_path.stat().st_mtime_ns):
+        out.append(sheet)
+        _walk_sch_subsheets(sch_dir / sheet.file, out, seen)
 
+def get_sch_subsheets_recursive(sch_path):
+    sheets = []
+    _walk_sch_subsheets(sch_path, sheets, set())
     return sheets
 
+class SheetCache:
+    '''
+    get_sch_subsheets_recursive の結果をトップシートの mtime が
+    変わるまで使い回す。リクエストごとの再走査を省くためのもの。
+    '''
+    def __init__(self):
+        self._mtime = None
+        self._sheets = None
+        self._lock = threading.Lock()
+
+    def get(self, sch_path):
+        mtime = sch_path.stat().st_mtime_ns
+        with self._lock:
+            if self._sheets is None or mtime != self._mtime:
+                self._sheets = get_sch_subsheets_recursive(sch_path)
+                self._mtime = mtime
+            return self._sheets
+
 def try_parse_float(value, default):
     try:
         return float(value)
@@ -252,11 +353,15 @@ def get_query_first_arg(url_query, key):
     else:
         return val[0]
 
+# レンダリング済みの diff ページを ETag で引くキャッシュ
+DIFF_PAGE_CACHE_SIZE = 32
+_diff_page_cache = OrderedDict()
+
 def action_diff(req, diff_base, diff_target, obj):
     obj_list = req.layers
 
     if req.sch_path:
-        sheets = get_sch_subsheets_recursive(req.sch_path)
+        sheets = req.sheet_cache.get(req.sch_path)
         files = [sh.file for sh in sheets] + [req.sch_path]
         names = [Path(f).stem for f in files]
         obj_list = req.layers + names
@@ -270,35 +375,54 @@ def action_diff(req, diff_base, diff_target, obj):
     commit_logs = req.kicad_repo.git_repo.get_commit_logs()
     backup_versions = req.kicad_repo.backups_repo.get_versions()
 
-    t = req.jinja_env.get_template('diffpcb.html')
-    s = t.render(base_commit_id=diff_base,
-                 target_commit_id=diff_target,
-                 obj_list=obj_list,
-                 layer=obj,
-                 commit_logs=commit_logs,
-                 backup_versions=backup_versions,
-                 fit_board=req.fit_board,
-                 mode=mode,
-                 current_zoom=try_parse_float(get_query_first_arg(req.url_query, 'zoom'), 1),
-                 trans_x=try_parse_float(get_query_first_arg(req.url_query, 'trans_x'), 0),
-                 trans_y=try_parse_float(get_query_first_arg(req.url_query, 'trans_y'), 0)
-                 ).encode('utf-8')
+    # HEAD・バックアップ一覧・回路図の階層・URL が変わらなければ
+    # レンダリング結果も同じ
+    head = commit_logs[0].hash if commit_logs else ''
+    sch_mtime = req.sch_path.stat().st_mtime_ns if req.sch_path else 0
+    etag_src = f'{head}-{",".join(backup_versions)}-{sch_mtime}-{req.path}'
+    etag = '"' + hashlib.blake2b(etag_src.encode('utf-8'), digest_size=8).hexdigest() + '"'
+
+    if req.headers.get('If-None-Match') == etag:
+        req.send_response(http.HTTPStatus.NOT_MODIFIED)
+        req.send_header('ETag', etag)
+        req.end_headers()
+        return
+
+    s = _diff_page_cache.get(etag)
+    if s is None:
+        t = req.jinja_env.get_template('diffpcb.html')
+        s = t.render(base_commit_id=diff_base,
+                     target_commit_id=diff_target,
+                     obj_list=obj_list,
+                     layer=obj,
+                     commit_logs=commit_logs,
+                     backup_versions=backup_versions,
+                     fit_board=req.fit_board,
+                     mode=mode,
+                     current_zoom=try_parse_float(get_query_first_arg(req.url_query, 'zoom'), 1),
+                     trans_x=try_parse_float(get_query_first_arg(req.url_query, 'trans_x'), 0),
+                     trans_y=try_parse_float(get_query_first_arg(req.url_query, 'trans_y'), 0)
+                     ).encode('utf-8')
+        _diff_page_cache[etag] = s
+        if len(_diff_page_cache) > DIFF_PAGE_CACHE_SIZE:
+            _diff_page_cache.popitem(last=False)
     req.send_response(200)
     req.send_header('Content-Type', 'text/html')
     req.send_header('Content-Length', len(s))
+    req.send_header('ETag', etag)
     req.end_headers()
     req.wfile.write(s)
 
 class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     protocol_version = 'HTTP/1.1'
-    timeout = 0.5
+    # 放置された keep-alive 接続がスレッドを占有し続けないようにする
+    timeout = 60
     '''
-    ThreadingHTTPServerを使う方が本質的な解消ができると思うが、
-    マルチスレッドの複雑さやログが入り乱れることを避けるために
-    ソケットのタイムアウト設定で凌ぐことにする。
+    ThreadingHTTPServer で動かすため、リクエストは並行に処理される。
+    重い kicad-cli の実行は _export_locks で直列化・重複排除している。
     '''
 
-    def __init__(self, tmp_dir_path, kicad_repo, jinja_env, pcb_path, sch_path, kicad_cli, layers, *args, **kwargs):
+    def __init__(self, tmp_dir_path, kicad_repo, jinja_env, pcb_path, sch_path, kicad_cli, layers, sheet_cache, *args, **kwargs):
         self.tmp_dir_path = tmp_dir_path
         self.kicad_repo = kicad_repo
         self.jinja_env = jinja_env
@@ -306,6 +430,7 @@ class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         self.sch_path = sch_path
         self.kicad_cli = kicad_cli
         self.layers = layers
+        self.sheet_cache = sheet_cache
         self.traceid = uuid.uuid4()
 
         logger.debug('HTTPRequestHandler.__init__(%s): args=%s kwargs=%s', self.traceid, args, kwargs)
@@ -316,23 +441,27 @@ class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     def do_GET(self):
         logger.info('do_GET path=%s traceid=%s', self.path, self.traceid)
         try:
-            self.url_parts = urllib.parse.urlparse(self.path)
-            self.url_query = urllib.parse.parse_qs(self.url_parts.query)
+            # クエリが無いのが普通なので urlparse/parse_qs を通さない
+            url_path, _, url_query = self.path.partition('?')
+            self.url_query = urllib.parse.parse_qs(url_query) if url_query else {}
             self.fit_board = get_query_first_arg(self.url_query, 'fit_board') == 'true'
 
             logger.info(f"{self.url_query=}")
 
-            if self.url_parts.path == '/':
+            if url_path == '/':
                 self.send_response(http.HTTPStatus.MOVED_PERMANENTLY)
                 self.send_header('Location', '/diff/HEAD/WORK/F.Cu')
+                # keep-alive ではボディ末尾を示すものが必要
+                self.send_header('Content-Length', '0')
                 self.end_headers()
                 return
 
-            if not self.url_parts.path.startswith('/'):
+            if not url_path.startswith('/'):
                 self.send_error(http.HTTPStatus.NOT_FOUND)
                 return
 
-            path_parts = [urllib.parse.unquote(p) for p in self.url_parts.path[1:].split('/')]
+            path_parts = [urllib.parse.unquote(p) if '%' in p else p
+                          for p in url_path[1:].split('/')]
             if len(path_parts) <= 1:
                 self.send_error(http.HTTPStatus.NOT_FOUND)
                 return
@@ -481,13 +610,19 @@ def main():
 
         jinja_env = jinja2.Environment(
             loader=jinja2.FileSystemLoader(str(Path(__file__).parent / 'templates')),
-            autoescape=jinja2.select_autoescape()
+            autoescape=jinja2.select_autoescape(),
+            auto_reload=False
         )
-        create_handler = handler_factory(tmp_dir_path, kicad_repo, jinja_env, pcb_path, sch_path, kicad_cli, layers)
-        with http.server.HTTPServer((host, port), create_handler) as server:
-            print(f'Serving HTTP on {host} port {port}'
-                  + f' (http://{access_host}:{port}/) ...')
-            server.serve_forever()
+        # 起動時にコンパイルしておけば、以降の get_template はキャッシュ参照だけになる
+        jinja_env.get_template('diffpcb.html')
+        create_handler = handler_factory(tmp_dir_path, kicad_repo, jinja_env, pcb_path, sch_path, kicad_cli, layers, SheetCache())
+        try:
+            with http.server.ThreadingHTTPServer((host, port), create_handler) as server:
+                print(f'Serving HTTP on {host} port {port}'
+                      + f' (http://{access_host}:{port}/) ...')
+                server.serve_forever()
+        finally:
+            backups_repo.close()
 
     sys.exit(0)
 
@@ -45,6 +45,15 @@ class TestRepo(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
 
+    def test_extract_file_datelike_ref(self):
+        # 日付で始まるだけの ref が backups 側へ誤って振り分けられないこと
+        pygit_repo = git.Repo(self.tmpdir / 'repo')
+        pygit_repo.create_tag('2025-07-19_113432x', ref=self.initial_commit)
+
+        dst_path = self.extract_dir / 'name7/name8.kicad_sch'
+        self.repo.extract_file('2025-07-19_113432x', 'sample.kicad_sch', dst_path)
+        self.assertFalse(diff_files(dst_path, kicad_files_dir / 'sample1/sample.kicad_sch'))
+
     def test_extract_file(self):
         dst_path = self.extract_dir / 'name1/name2.kicad_sch'
         self.repo.extract_file(None, 'sample.kicad_sch', dst_path)
@@ -71,3 +80,16 @@ class TestRepo(unittest.TestCase):
     def test_get_versions(self):
         self.assertEqual(self.backups_repo.get_versions(),
                          ['2025-07-19_113432', '2025-07-19_112922', '2025-07-19_112346'])
+
+class TestIsBackupDate(unittest.TestCase):
+    def test_valid(self):
+        self.assertTrue(kidivis.repo.is_backup_date('2025-07-19_113432'))
+
+    def test_invalid(self):
+        self.assertFalse(kidivis.repo.is_backup_date('2025-07-19_11343'))    # 短い
+        self.assertFalse(kidivis.repo.is_backup_date('2025-07-19_113432x'))  # 末尾に余計な文字
+        self.assertFalse(kidivis.repo.is_backup_date('x2025-07-19_113432'))  # 先頭に余計な文字
+        self.assertFalse(kidivis.repo.is_backup_date('2025_07-19-113432'))   # 区切りの位置が違う
+        self.assertFalse(kidivis.repo.is_backup_date('2025-07-19x113432'))
+        self.assertFalse(kidivis.repo.is_backup_date('2025-07-19_11343x'))   # 数字でない
+        self.assertFalse(kidivis.repo.is_backup_date('20x5-07-19_113432'))
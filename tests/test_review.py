@@ -52,10 +52,10 @@ class TestSchOperations(unittest.TestCase):
 
     def test_property_regex(self):
         m = kidivis.review.SCH_PROPERTY_PAT.match(
-            '(property "Sheetfile" "analog.kicad_sch"')
+            b'(property "Sheetfile" "analog.kicad_sch"')
         self.assertIsNotNone(m)
-        self.assertEqual(m.group('name'), 'Sheetfile')
-        self.assertEqual(m.group('value'), 'analog.kicad_sch')
+        self.assertEqual(m.group('name'), b'Sheetfile')
+        self.assertEqual(m.group('value'), b'analog.kicad_sch')
 
     def test_get_sch_subsheets(self):
         self.assertEqual(